@@ -9,28 +9,27 @@
 # Guido Muesch <g.muesch@gmail.com>
 # 
 
+import os
 import sys
 import asyncio
-import async_timeout
 import signal
-from colored import cprint, fg, bg, attr, set_tty_aware
-from time import time, sleep
-from datetime import timedelta, datetime
+from colored import fg, bg, attr, set_tty_aware
+from time import time
 from bleak import BleakClient
 from bleak.exc import BleakError
-from bleak.uuids import uuid16_dict, uuid128_dict, uuidstr_to_str, register_uuids
 
 #from bleak.backends.corebluetooth import CBCharacteristicProperties
 
 #from bleak_retry_connector import establish_connection
 
 import platform
-from functools import partial
+import random
+from functools import partial, lru_cache
 from bleak import BleakScanner
-from enum import Enum, IntEnum
+from collections import defaultdict, Counter, deque
 
 import traceback
-from lib import bytes2str, uuid_to_name, name_to_uuid, xreport
+from lib import bytes2str, uuid_to_name, name_to_uuid, xreport as lib_xreport
 #from polar import polar, pmd_data_notification, POLAR_PMD_DATA, Polar_Supported_Characteristics, Polar_UUIDS
 from polar import Polar
 from moxy import Moxy
@@ -38,32 +37,46 @@ from vo2master import VO2Master
 
 #register_uuids(Polar_UUIDS)
 
+# uuid_to_name is called for every notification, the same few uuids are looked up repeatedly
+uuid_to_name = lru_cache(maxsize=512)(uuid_to_name)
+
 #OxySmart_UUIDS = {
 #}
 #6e400001-b5a3-f393-e0a9-e50e24dcca9e (Handle: 6): Nordic UART Service
 #6e400002-b5a3-f393-e0a9-e50e24dcca9e (Handle: 7): Nordic UART RX (write-without-response,write), Value: None
 #6e400003-b5a3-f393-e0a9-e50e24dcca9e (Handle: 9): Nordic UART TX (notify), Value: None
 
-statistics = {}
+# statistics[device_name][measurement_name] -> notification count
+statistics = defaultdict(Counter)
+
+# notification_counts[device_name][char_uuid] -> notification count, uuids are resolved to names only when reported
+notification_counts = defaultdict(Counter)
+
+# a recurring exception in a notification callback prints its traceback at most once
+# per EXCEPTION_LOG_INTERVAL seconds for each (device_name, exception type)
+EXCEPTION_LOG_INTERVAL = 5
+exception_log_times = {}
+
+def print_exception_limited(e, device_name=None):
+    log_write('%r\n' % (e, ))
+    key = (device_name, type(e))
+    now = time()
+    if now - exception_log_times.get(key, 0) > EXCEPTION_LOG_INTERVAL:
+        exception_log_times[key] = now
+        log_write(traceback.format_exc())
 
 def xnotification(sender, data, myclient=None, device_name=None, supported_devices=None ):
     try:
         xreport(device_name, 'notification', '%s:%s' % (uuid_to_name(sender.uuid), len(data), ))
-        if device_name not in statistics:
-            statistics[device_name] = {}
         for device in supported_devices:
             if device.data_check(sender.uuid):
                 device.notification(sender.uuid, data, myclient=myclient, device_name=device_name, statistics=statistics)
         #if sender.uuid == POLAR_PMD_DATA:
         #    notification(sender, data, device_name)
         #    return
-        measurement_name = uuid_to_name(sender.uuid)
-        if measurement_name not in statistics[device_name]:
-            statistics[device_name][measurement_name] = 0
-        statistics[device_name][measurement_name] += 1
+        notification_counts[device_name][sender.uuid] += 1
     except Exception as e:
-        print(e)
-        print(traceback.format_exc(), file=sys.stderr)
+        print_exception_limited(e, device_name)
 
 supported_characteristics = {
     'Battery Service': {
@@ -124,9 +137,72 @@ supported_characteristics = {
     },
 }
 
+# name_to_uuid, None if the name is not known
+def lookup_uuid(name):
+    try:
+        uuid = name_to_uuid(name)
+    except Exception:
+        return None
+    return None if uuid is None else uuid.lower()
+
+# supported_characteristics resolved to uuids once at import for O(1) membership tests
+# supported_uuids[service_uuid][characteristic_type] -> frozenset of characteristic uuids
+supported_uuids = {
+    lookup_uuid(service_name): {
+        characteristic_type: frozenset(lookup_uuid(n) for n in characteristics.get(characteristic_type, []))
+        for characteristic_type in ('read', 'notify', 'ignore')
+    }
+    for service_name, characteristics in supported_characteristics.items() if characteristics
+}
+supported_uuids.pop(None, None)
+
+# uuid -> tuple of the supported devices that handle its notifications, every device whose data_check
+# accepts the uuid gets the notification, built once in main and shared by all device tasks
+def build_uuid_dispatch(supported_devices):
+    uuid_dispatch = {}
+    for characteristics in supported_uuids.values():
+        for char_uuid in characteristics['notify']:
+            uuid_dispatch[char_uuid] = tuple(device for device in supported_devices if device.data_check(char_uuid))
+    return uuid_dispatch
+
 #def report(device_name, operation='', msg='', fore='black', back='white'):
 #    cprint ('[%-30s %22s] %s' % (device_name, operation, msg), file=sys.stderr, fore_256=fore, back_256=back)
 
+# stderr lines are queued and written in batches by log_worker so that notification
+# callbacks do not block on stderr, written directly if log_worker is not running
+log_queue = deque()
+log_worker_running = False
+
+def log_write(line):
+    if log_worker_running:
+        log_queue.append(line)
+    else:
+        sys.stderr.write(line)
+
+def log_flush():
+    if log_queue:
+        batch = []
+        while log_queue:
+            batch.append(log_queue.popleft())
+        sys.stderr.write(''.join(batch))
+        sys.stderr.flush()
+
+# xreport (lib) writes to stderr directly, write the queued lines first to keep the output in order
+def xreport(*args, **kwargs):
+    log_flush()
+    lib_xreport(*args, **kwargs)
+
+async def log_worker(interval=0.02):
+    global log_worker_running
+    log_worker_running = True
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            log_flush()
+    finally:
+        log_worker_running = False
+        log_flush()
+
 
 
 
@@ -135,69 +211,62 @@ supported_characteristics = {
 async def device_explore(myclient, device, task_stop_event, supported_devices,):
     client = myclient.client
     myclient.report('Connected', '', fore='black', back='light_yellow', ) 
-    print('supported_devices: %s' % ([supported_devices], ), file=sys.stderr)
+    log_write('supported_devices: %s\n' % ([supported_devices], ))
 
-    def supported_characteristic(service_name, characteristic_name, characteristic_type):
-        if service_name not in supported_characteristics or supported_characteristics[service_name] is None:
-            #print('[%-28s %6s] not supported: %s:%s UNKNOWN' % (device_name, characteristic_type, service_name, characteristic_name), file=sys.stderr)
-            return False
-        if characteristic_type not in supported_characteristics[service_name]:
-            #print('[%-28s %6s] not supported: %s:%s NONE' % (device_name, characteristic_type, service_name, characteristic_name), file=sys.stderr)
+    def supported_characteristic(supported, char_uuid, characteristic_type):
+        if supported is None:
             return False
-        if uuid_to_name(char_uuid) not in supported_characteristics[service_name][characteristic_type]:
-            #print('[%-28s %6s] not supported: %s:%s' % (device_name, characteristic_type, service_name, characteristic_name), file=sys.stderr)
-            return False
-        return True
+        return char_uuid in supported[characteristic_type]
 
     device_name = device.name
 
     # Look at Services
     try:
+        # walk the services once per device, reconnects reuse the saved plan
+        plan = myclient.service_plan()
+
         services = {}
-        for service in client.services:
-            service_name = uuid_to_name(service.uuid)
-            services[service.uuid] = []
+        read_plan = []
+        notify_plan = []
+        for service_uuid, service_plan in plan.items():
+            service_name = service_plan['name']
+            services[service_uuid] = []
             myclient.report('service', '%s' % (service_name, ))
 
-            reads = [ char.uuid for char in service.characteristics if 'read' in char.properties ]
-            read_names = [ uuid_to_name(char.uuid) for char in service.characteristics if 'read' in char.properties ]
-            notifications = [ char.uuid for char in service.characteristics if 'notify' in char.properties or 'indicate' in char.properties ]
-            notification_names = [ uuid_to_name(char.uuid) for char in service.characteristics if 'notify' in char.properties or 'indicate' in char.properties ]
-
-            if reads != []:
-                for i, r in enumerate(read_names):
-                    myclient.report('reads', '%d: %s' % (i, r, ))
-            if notifications != []:
-                #myclient.report('notifications', '%s' % (notifications, ))
-                for i, n in enumerate(notification_names):
-                    myclient.report('notifications', '%d: %s' % (i, n, ))
-
-            for char_uuid in reads:
-                characteristic_name = uuid_to_name(char_uuid)
-                if not supported_characteristic(service_name, characteristic_name, 'read'):
-                    continue
-                response = await myclient.read_gatt_char(char_uuid)
-                #print('READ: %s' % (char_uuid, ), file=sys.stderr)
-                #print('READ: %s' % (uuid_to_name(char_uuid), ), file=sys.stderr)
-                if response is None:
-                    myclient.report('read', '%s read failed' % (char_uuid, ))
-                    return False
-                if 'string' in uuid_to_name(char_uuid):
-                    response = bytes2str(response)
-                myclient.report('read', '%s:%s %s' % 
-                    (service_name, characteristic_name,
-                     ''.join(map(chr, response)) if 'string' in uuid_to_name(char_uuid).lower() else bytes2str(response), 
-                                                          ))
-
-            for char_uuid in notifications:
-                if not supported_characteristic(service_name, uuid_to_name(char_uuid), 'notify'):
-                    continue
-                if not await myclient.start_notify(char_uuid, myclient.notification, supported_devices, ):
-                    myclient.report('start_notify', 'Failed') 
-                    return False
+            reads = service_plan['read']
+            notifications = service_plan['notify']
+
+            for i, (char_uuid, characteristic_name) in enumerate(reads):
+                myclient.report('reads', '%d: %s' % (i, characteristic_name, ))
+            for i, (char_uuid, characteristic_name) in enumerate(notifications):
+                myclient.report('notifications', '%d: %s' % (i, characteristic_name, ))
+
+            supported = supported_uuids.get(service_uuid)
+
+            read_plan += [ (service_name, char_uuid, characteristic_name) for char_uuid, characteristic_name in reads
+                if supported_characteristic(supported, char_uuid, 'read') ]
+            notify_plan += [ char_uuid for char_uuid, characteristic_name in notifications
+                if supported_characteristic(supported, char_uuid, 'notify') ]
+
+        # the reads and start_notify calls are independent, issue them together instead of one round trip each
+        responses = await asyncio.gather(*[ myclient.read_gatt_char(char_uuid) for _, char_uuid, _ in read_plan ], return_exceptions=True)
+        for (service_name, char_uuid, characteristic_name), response in zip(read_plan, responses):
+            #print('READ: %s' % (char_uuid, ), file=sys.stderr)
+            #print('READ: %s' % (uuid_to_name(char_uuid), ), file=sys.stderr)
+            if response is None or isinstance(response, Exception):
+                myclient.report('read', '%s read failed' % (char_uuid, ))
+                return False
+            is_string = 'string' in characteristic_name.lower()
+            text = response.decode('utf-8', 'replace') if is_string else bytes2str(response)
+            myclient.report('read', '%s:%s %s' % (service_name, characteristic_name, text, ))
+
+        results = await asyncio.gather(*[ myclient.start_notify(char_uuid, supported_devices, ) for char_uuid in notify_plan ], return_exceptions=True)
+        if not all(result is True for result in results):
+            myclient.report('start_notify', 'Failed') 
+            return False
     except Exception as e:
-        print('Exception: %s' % (e, ), file=sys.stderr)
-        traceback.print_exc()
+        log_write('Exception: %s\n' % (e, ))
+        log_write(traceback.format_exc())
         return False
 
     try:
@@ -208,8 +277,8 @@ async def device_explore(myclient, device, task_stop_event, supported_devices,):
             #else:
             #    report(device.name, device.name, 'not found') 
     except Exception as e:
-        print('Exception: %s' % (e, ), file=sys.stderr)
-        traceback.print_exc()
+        log_write('Exception: %s\n' % (e, ))
+        log_write(traceback.format_exc())
 
     myclient.report('device_task', 'waiting for stop event')
     await task_stop_event.wait()
@@ -218,53 +287,117 @@ async def device_explore(myclient, device, task_stop_event, supported_devices,):
     return True
 
 
+# error backoff, seconds, doubled on each consecutive error and reset on success
+BACKOFF_MIN = 0.1
+BACKOFF_MAX = 4.0
+
 # super class ble client to handle notifications and data collection and get consistent exception handling
 class MyClient:
-    def __init__(self, device, task_stop_event, support_list):
+    def __init__(self, device, task_stop_event, support_list, uuid_dispatch):
         self.device = device
         self.task_stop_event = task_stop_event
         self.client = None
         self.services = {}
         self.characteristics = {}
+        self.service_plans = {}
+        self._first_connect = True
+        self._notify_cb = {}
+        self._backoff = BACKOFF_MIN
         self.support_list = support_list
+        # used by the notification callback, bound here instead of in a partial per subscription
+        self._device_name = device.name
+        self._supported_devices = support_list
+        self._uuid_dispatch = uuid_dispatch
         self.start_time = time()
+        self._name_field = '%-20s' % (self.device.name, )
+        # BLEEXPLORE_VERBOSE=2 also shows per packet and per read/write messages
+        self._verbose = int(os.environ.get('BLEEXPLORE_VERBOSE', '1'))
+        self._color = sys.stderr.isatty()
 
-    def notification(self, sender, data, device_name=None, supported_devices=None ):
+    # bleak notification callback, registered directly as a bound method
+    def notification(self, sender, data):
         try:
-            found = False
-            if device_name not in statistics:
-                statistics[device_name] = {}
-
-            for device in supported_devices:
-                if device.data_check(sender.uuid):
-                    #self.report('notification', 'data_check %s True' % (device.name), )
-                    device.notification(sender.uuid, data, myclient=self, device_name=device_name, statistics=statistics)
-                    found = True
-                #else:
-                #    self.report('notification', 'data_check %s False' % (device.name), )
-
-            if not found:
-                self.report('notification', '%s:%s' % (uuid_to_name(sender.uuid), len(data), ))
+            handlers = self._notify_cb.get(sender.uuid)
+            if handlers is None:
+                handlers = self._notify_cb[sender.uuid] = self.device_notification(sender.uuid, self._supported_devices)
+            for cb in handlers:
+                cb(sender.uuid, data, myclient=self, device_name=self._device_name, statistics=statistics)
+            if not handlers:
+                self.report_lazy('notification', lambda: '%s:%s' % (uuid_to_name(sender.uuid), len(data), ))
             #if sender.uuid == POLAR_PMD_DATA:
             #    notification(sender, data, device_name)
             #    return
-            measurement_name = uuid_to_name(sender.uuid)
-            if measurement_name not in statistics[device_name]:
-                statistics[device_name][measurement_name] = 0
-            statistics[device_name][measurement_name] += 1
+            notification_counts[self._device_name][sender.uuid] += 1
         except Exception as e:
-            print(e)
-            print(traceback.format_exc(), file=sys.stderr)
-
-    
-    def report(self, operation='', msg='', fore='black', back='white'):
-        elapsed = int(time() - self.start_time)
-        cprint ('[%3d:%02d %-20s %22s] %s' % (elapsed//60, elapsed%60, self.device.name, operation, msg), file=sys.stderr, fore_256=fore, back_256=back)
+            print_exception_limited(e, self._device_name)
+
+    # find the notification handlers of the supported devices for this characteristic, done once per uuid per connection
+    # uuids missing from uuid_dispatch (not in supported_characteristics) are looked up and added
+    def device_notification(self, char_uuid, supported_devices):
+        devices = self._uuid_dispatch.get(char_uuid)
+        if devices is None:
+            devices = self._uuid_dispatch[char_uuid] = tuple(device for device in supported_devices if device.data_check(char_uuid))
+        return tuple(device.notification for device in devices)
+
+    # single pass over client.services, saved by device address so reconnects skip the walk,
+    # rebuilt if the device now has a different set of services (GATT database changed)
+    # plan: { service_uuid: { 'name': service_name, 'read': [(uuid, name)], 'notify': [(uuid, name)] } }
+    def service_plan(self):
+        address = self.device.address
+        services = self.client.services
+        plan = self.service_plans.get(address)
+        if plan is not None:
+            if plan.keys() == { service.uuid for service in services }:
+                return plan
+            self.report('service_plan', 'services changed', fore='black', back='light_yellow', )
+            self.invalidate_services()
+        plan = {}
+        for service in services:
+            reads = []
+            notifs = []
+            for char in service.characteristics:
+                props = char.properties
+                char_name = uuid_to_name(char.uuid)
+                if 'read' in props:
+                    reads.append((char.uuid, char_name))
+                if 'notify' in props or 'indicate' in props:
+                    notifs.append((char.uuid, char_name))
+            plan[service.uuid] = {'name': uuid_to_name(service.uuid), 'read': reads, 'notify': notifs, }
+        self.service_plans[address] = plan
+        return plan
+
+    def report(self, operation='', msg='', fore='black', back='white', level=1):
+        if level > self._verbose:
+            return
+        minutes, seconds = divmod(int(time() - self.start_time), 60)
+        line = '[%3d:%02d %s %22s] %s' % (minutes, seconds, self._name_field, operation, msg)
+        if self._color:
+            line = '%s%s%s%s' % (fg(fore), bg(back), line, attr('reset'))
+        log_write(line + '\n')
+
+    # report with the message built by msg_func only if it will be shown, for per packet messages
+    def report_lazy(self, operation, msg_func, fore='black', back='white', level=2):
+        if level > self._verbose:
+            return
+        self.report(operation, msg_func(), fore=fore, back=back, level=level)
 
     def disconnected_callback(self, client, device_name=None, disconnect_event=None):
         self.report(operation='disconnected', msg='', fore='black', back='light_yellow', )
         disconnect_event.set()
 
+    # forget the saved services, the next connect resolves them from the device
+    def invalidate_services(self):
+        self._first_connect = True
+        self.service_plans.pop(self.device.address, None)
+
+    # sleep after an error, exponential with jitter so a burst of errors does not stall other devices
+    async def backoff(self):
+        await asyncio.sleep(self._backoff * random.uniform(0.5, 1.5))
+        self._backoff = min(self._backoff * 2, BACKOFF_MAX)
+
+    def backoff_reset(self):
+        self._backoff = BACKOFF_MIN
+
     def is_connected(self):
         return self.client.is_connected
 
@@ -273,6 +406,7 @@ class MyClient:
 
     async def connect(self):
         self.task_stop_event.clear()
+        self._notify_cb = {}
 
        ## test establish_connection from bleak retry package
        #if False:
@@ -304,23 +438,32 @@ class MyClient:
 
             self.report('Connection', 'Connecting', fore='black', back='light_yellow', )
 
-            # await connection
-            await self.client.connect(timeout=10.)
+            # await connection, on reconnect use the services bleak already resolved (BlueZ only, other backends ignore it)
+            if self._first_connect:
+                await self.client.connect(timeout=10.)
+            else:
+                await self.client.connect(timeout=10., dangerous_use_bleak_cache=True)
+            self._first_connect = False
             self.report('Connection', 'Connected')
 
         # catch exceptions and retry as necessary
         except asyncio.exceptions.TimeoutError as e:
             self.report('Connection', 'Timeout')
             self.task_stop_event.set()
+            await self.backoff()
             return False
         except BleakError as e:
             self.report('BleakError waiting for client.connect e: %s' % (e), fore='black', back='indian_red_1c', )
+            self.invalidate_services()
             self.task_stop_event.set()
+            await self.backoff()
             return False
         except Exception as e:
             self.report('Exception waiting for client.connect e: %s' % (e), fore='black', back='indian_red_1c', )
             self.task_stop_event.set()
+            await self.backoff()
             return False
+        self.backoff_reset()
         return True
 
     async def write_gatt_char(self, char_uuid, command, ):
@@ -329,7 +472,7 @@ class MyClient:
             self.report('write_gatt_char', '%s %s task_stop_event set' % (bytes2str(command ), uuid_to_name(char_uuid), ))
             return False
 
-        self.report('write_gatt_char', '%s %s' % (bytes2str(command ), uuid_to_name(char_uuid), ))
+        self.report_lazy('write_gatt_char', lambda: '%s %s' % (bytes2str(command ), uuid_to_name(char_uuid), ))
        # print('[%-30s %4s] %s %s' % (name, service, bytes2str(command), msg), file=sys.stderr)
         try:
             await self.client.write_gatt_char(char_uuid, command)
@@ -337,18 +480,19 @@ class MyClient:
         except EOFError as e:
             self.task_stop_event.set()
             self.report('write_gatt_char', 'EOFError %s ...' % (e, ), fore='black', back='indian_red_1c', )
-            await asyncio.sleep(2)
+            await self.backoff()
             return False
             #print('[%-30s %4s] EOFError %s ...' % (name, service, e), file=sys.stderr)
         except BleakError as e:
             self.task_stop_event.set()
             self.report('write_gatt_char', 'BleakDBusError %s ...' % (e, ), fore='black', back='light_red', )
-            await asyncio.sleep(2)
+            await self.backoff()
             return False
         except Exception as e:
-            await asyncio.sleep(2)
-            print(traceback.format_exc(), file=sys.stderr)
+            await self.backoff()
+            log_write(traceback.format_exc())
             return False
+        self.backoff_reset()
         return True
 
     async def read_gatt_char(self, char_uuid, ):
@@ -366,42 +510,46 @@ class MyClient:
         except EOFError as e:
             self.task_stop_event.set()
             self.report('read_gatt_char', 'EOFError %s ...' % (e, ), fore='black', back='indian_red_1c', )
-            await asyncio.sleep(2)
+            await self.backoff()
             return None
         except BleakError as e:
             self.task_stop_event.set()
             self.report('read_gatt_char', 'BleakDBusError %s ...' % (e, ), fore='black', back='indian_red_1c', )
-            print(traceback.format_exc(), file=sys.stderr)
-            await asyncio.sleep(2)
+            log_write(traceback.format_exc())
+            await self.backoff()
             return None
-        self.report('read_gatt_char', '%s: %s' % (uuid_to_name(char_uuid), bytes2str(response) if response else 'None'))
+        self.backoff_reset()
+        self.report_lazy('read_gatt_char', lambda: '%s: %s' % (uuid_to_name(char_uuid), bytes2str(response) if response else 'None'))
         return response
 
-    async def start_notify(self, char_uuid, notification, supported_devices, ):
+    async def start_notify(self, char_uuid, supported_devices, ):
 
         if self.task_stop_event.is_set():
             self.report('start_notify', '%s task_stop_event set' % (uuid_to_name(char_uuid), ))
             return False
 
         #self.report('start_notify', '%s' % (uuid_to_name(char_uuid), ))
+        if char_uuid not in self._notify_cb:
+            self._notify_cb[char_uuid] = self.device_notification(char_uuid, supported_devices)
         try:
-            await self.client.start_notify(char_uuid, partial(self.notification, device_name=self.device.name, supported_devices=supported_devices, ))
+            await self.client.start_notify(char_uuid, self.notification)
 
         except BleakError as e:
             self.report('start_notify', 'BleakDBusError %s ...' % (e, ), fore='black', back='indian_red_1c', )
-            await asyncio.sleep(2)
+            await self.backoff()
             return False
+        self.backoff_reset()
         self.report('start_notify', '%s OK' % (uuid_to_name(char_uuid), ))
         return True
 
     
 
-async def device_task(device, task_stop_event, supported_devices, ):
+async def device_task(device, task_stop_event, supported_devices, uuid_dispatch, ):
     try:
         xreport(device.name, 'device_task starting')
 
         # task_stop_event is set when the connection stops
-        myclient = MyClient(device, task_stop_event, supported_devices,)
+        myclient = MyClient(device, task_stop_event, supported_devices, uuid_dispatch, )
 
         while True:
             if not await myclient.connect():
@@ -416,29 +564,19 @@ async def device_task(device, task_stop_event, supported_devices, ):
             xreport(device.name, 'Connection', 'Normal Disconnect')
             continue
 
+    # asyncio.exceptions.CancelledError is the same class
     except asyncio.CancelledError:
-        xreport(device.name, 'device_task', 'asyncio.CancelledError', fore='black', back='light_yellow', )
-        xreport(device.name, 'device_task', e, fore='black', back='light_yellow', )
-        raise asyncio.CancelledError()
-    except asyncio.exceptions.CancelledError as e:
-        xreport(device.name, 'device_task', 'asyncio.exceptions.CancelledError', fore='black', back='light_yellow', )
-        xreport(device.name, 'device_task', e, fore='black', back='light_yellow', )
-        raise asyncio.exceptions.CancelledError()
+        xreport(device.name, 'device_task', 'cancelled', fore='black', back='light_yellow', )
+        raise
     except Exception as e: 
-        xreport(device.name, 'device_task', 'Exception', fore='black', back='light_yellow', )
-        xreport(device.name, 'device_task', e, fore='black', back='light_yellow', )
-        print(traceback.format_exc(), file=sys.stderr)
-        raise asyncio.exceptions.CancelledError()
+        xreport(device.name, 'device_task', 'Exception %s' % (e, ), fore='black', back='light_yellow', )
+        raise asyncio.CancelledError()
     finally:
         try:
-            xreport(device.name, 'device_task', 'Finally Disconnecting')
             await myclient.disconnect()
-            xreport(device.name, 'Connection', 'Final Disconnect')
+            xreport(device.name, 'device_task', 'finished, disconnected', fore='black', back='light_yellow', )
         except Exception as e:
-            xreport(device.name, 'device_task', 'Exception %s' % (e, ), fore='black', back='indian_red_1c', )
-            print(traceback.format_exc(), file=sys.stderr)
-        finally:
-            xreport(device.name, 'device_task', 'finished', fore='black', back='light_yellow', )
+            xreport(device.name, 'device_task', 'finished, disconnect Exception %s' % (e, ), fore='black', back='indian_red_1c', )
         return True
 
 def handle_task_result(task):
@@ -450,13 +588,14 @@ def handle_task_result(task):
         xreport(name, 'Cancelled', fore='black', back='light_yellow',  )
     except Exception as e:
         xreport(name, 'Exception', e, fore='black', back='light_yellow',  )
-        print(traceback.format_exc(), file=sys.stderr)
+        log_write(traceback.format_exc())
     finally:
         pass
         
 
 async def main(argv):
 
+    log_task = asyncio.create_task(log_worker(), name='log_worker')
     xreport('Scanner', 'Scanning', '%s' % (argv), )
     tasks = {}
     stop_event = asyncio.Event()
@@ -464,25 +603,35 @@ async def main(argv):
     def sigint_handler():
         stop_event.set()
 
-    signal.signal(signal.SIGINT, lambda signal, frame: sigint_handler())
+    # add_signal_handler wakes the event loop immediately, not available on Windows
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, sigint_handler)
+    except NotImplementedError:
+        signal.signal(signal.SIGINT, lambda signal, frame: sigint_handler())
 
     supported_devices = [Polar(), Moxy(), VO2Master(), ]
+    uuid_dispatch = build_uuid_dispatch(supported_devices)
+
+    # called for every advertisement, lower case the wanted names once
+    wanted = tuple(a.lower() for a in argv)
 
     def detection_callback(dev=None, ad=None, ):
         #print('[%-35s] detection_callback dev: %s' % ('BleakScanner', dir(dev), ), file=sys.stderr)
         #print('[%-35s] detection_callback tasks: %s' % ('BleakScanner', tasks), file=sys.stderr)
 
         #if dev.name is not None and wanted_name.lower() in dev.name.lower() and dev.name not in tasks:
-        if dev.name is not None and dev.name not in tasks:
-            for a in argv:
-                if a.lower() in dev.name.lower():
-                    xreport('Scanner', 'Found', dev.name, )
-                    task_stop_event = asyncio.Event()
-                    task_stop_events[dev.name] = task_stop_event
-                    tasks[dev.name] = asyncio.create_task(device_task(dev, task_stop_event, supported_devices, ), name=dev.name,)
-                    tasks[dev.name].add_done_callback(handle_task_result)   
-                    print('--------------------------------------------------------------------------------', file=sys.stderr)
-                    break
+        if dev.name is None or dev.name in tasks:
+            return
+        name = dev.name.lower()
+        if not any(w in name for w in wanted):
+            return
+        xreport('Scanner', 'Found', dev.name, )
+        task_stop_event = asyncio.Event()
+        task_stop_events[dev.name] = task_stop_event
+        tasks[dev.name] = asyncio.create_task(device_task(dev, task_stop_event, supported_devices, uuid_dispatch, ), name=dev.name,)
+        tasks[dev.name].add_done_callback(handle_task_result)   
+        log_write('--------------------------------------------------------------------------------\n')
     try:
         last_stop_time = 0
         async with BleakScanner(detection_callback=detection_callback, scanning_mode="active") as scanner:
@@ -508,13 +657,16 @@ async def main(argv):
                 except asyncio.CancelledError:
                     pass
                 except Exception as e:
-                    print(traceback.format_exc(), file=sys.stderr)
+                    log_write(traceback.format_exc())
                     pass
             xreport('Scanner', 'Gathering', '%s' % ([t for t in tasks.keys()]))
             #done_list = [x for x in tasks if x.done() ]
             await asyncio.gather(*[ task for name, task in tasks.items()], return_exceptions=True)
             xreport('Scanner', 'Tasks Gathered', '')
 
+        for device_name, counts in notification_counts.items():
+            for char_uuid, count in counts.items():
+                statistics[device_name][uuid_to_name(char_uuid)] += count
         for device_name, stats in statistics.items():
             print('')
             for measurement_name, count in stats.items():
@@ -522,19 +674,26 @@ async def main(argv):
         print('')
 
     except BleakError as e:
-        print('BleakDBusError %s ...' % (e), file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        log_write('BleakDBusError %s ...\n' % (e))
+        log_write(traceback.format_exc())
         if platform.system() == 'Linux':
-            print('[%-30s     ] You may need to restart Linux Bluetooth!' % (''), file=sys.stderr)
+            log_write('[%-30s     ] You may need to restart Linux Bluetooth!\n' % (''))
         await asyncio.sleep(2)
     except OSError as e:
-        print('OSError %s ...' % (e), file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        log_write('OSError %s ...\n' % (e))
+        log_write(traceback.format_exc())
         await asyncio.sleep(2)
     except Exception as e:
-        print('BLE_Scanner.task: e: %s' % (e, ), file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        log_write('BLE_Scanner.task: e: %s\n' % (e, ))
+        log_write(traceback.format_exc())
         await asyncio.sleep(2)
+    finally:
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except NotImplementedError:
+            pass
+        log_task.cancel()
+        await asyncio.gather(log_task, return_exceptions=True)
 
 if __name__ == "__main__":
     set_tty_aware(awareness=False)
@@ -542,4 +701,10 @@ if __name__ == "__main__":
         print('Usage: %s <device names>' % (sys.argv[0], ), file=sys.stderr)
         sys.exit(1)
     name = 'Polar' if len(sys.argv) == 1 else sys.argv[1]
+    # use uvloop if available, it has a faster event loop for callback heavy code, not available on Windows
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main(sys.argv[1:]))  # H10
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+# Copyright(c)2023 stuart.lynne@gmail.com
+# Made available under the MIT License
+# See LICENSE.md
+#
+## Contributors
+# Stuart Lynne <stuart.lynne@gmail.com>
+# Guido Muesch <g.muesch@gmail.com>
+#
+
+# Binary log of PMD data notifications.
+#
+# polartest.py writes one fixed size record per PMD data notification into a memory mapped
+# file (set POLARTEST_LOG=<file>), no formatting or system call is done per notification.
+# Run this script on the same file to format the records as they arrive:
+#
+#   python pmdlog.py <file>
+#
+# The file is a header followed by a ring of PMD_LOG_ENTRIES records, the header count is the
+# total number of records written, the oldest records are overwritten when the ring wraps.
+
+import os
+import sys
+import mmap
+import struct
+from time import sleep
+
+PMD_LOG_MAGIC = b'PMDL'
+PMD_LOG_HEADER = struct.Struct('<4sIQ')         # magic, entries, records written
+PMD_LOG_COUNT = struct.Struct('<Q')             # records written, at PMD_LOG_COUNT_OFFSET
+PMD_LOG_COUNT_OFFSET = 8
+PMD_LOG_RECORD = struct.Struct('<QBBHB3x')      # monotonic_ns, measurement, frametype, length, device
+PMD_LOG_ENTRIES = 4096                          # power of two
+
+# PMD measurement type -> name, also used by polartest.py
+pmdMeasurementTypes = {
+    0: "ECG",
+    1: "PPG",
+    2: "ACC",
+    3: "PPI",
+    5: "GYRO",
+    6: "MAG",
+}
+
+class PMDLog:
+    def __init__(self, path):
+        size = PMD_LOG_HEADER.size + PMD_LOG_ENTRIES * PMD_LOG_RECORD.size
+        with open(path, 'w+b') as f:
+            f.truncate(size)
+            self.mm = mmap.mmap(f.fileno(), size)
+        PMD_LOG_HEADER.pack_into(self.mm, 0, PMD_LOG_MAGIC, PMD_LOG_ENTRIES, 0)
+        self.count = 0
+        self.devices = {}
+
+    # small integer id for the device name, recorded in each record
+    def device_id(self, device_name):
+        return self.devices.setdefault(device_name, len(self.devices))
+
+    # ns is the monotonic_ns() time the notification was received
+    def write(self, device_id, ns, measurement, frametype, length):
+        offset = PMD_LOG_HEADER.size + (self.count & (PMD_LOG_ENTRIES - 1)) * PMD_LOG_RECORD.size
+        PMD_LOG_RECORD.pack_into(self.mm, offset, ns, measurement, frametype, length, device_id)
+        self.count += 1
+        PMD_LOG_COUNT.pack_into(self.mm, PMD_LOG_COUNT_OFFSET, self.count)
+
+    def close(self):
+        self.mm.close()
+
+
+def tail(path, interval=0.5):
+    with open(path, 'rb') as f:
+        # PMDLog creates the file empty and then sets its size, an empty file cannot be mapped
+        while os.fstat(f.fileno()).st_size < PMD_LOG_HEADER.size:
+            sleep(interval)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, entries, count = PMD_LOG_HEADER.unpack_from(mm, 0)
+    if magic != PMD_LOG_MAGIC:
+        print('%s: not a PMD log' % (path, ), file=sys.stderr)
+        return
+    last = count
+    while True:
+        count, = PMD_LOG_COUNT.unpack_from(mm, PMD_LOG_COUNT_OFFSET)
+        if count < last:
+            last = 0
+        if count - last > entries:
+            print('[%-6s] dropped %d records' % ('', count - last - entries, ))
+            last = count - entries
+        for n in range(last, count):
+            offset = PMD_LOG_HEADER.size + (n & (entries - 1)) * PMD_LOG_RECORD.size
+            ns, measurement, frametype, length, device_id = PMD_LOG_RECORD.unpack_from(mm, offset)
+            print('[%-6d %4s] %d.%09d %02x len: %s' %
+                (device_id, pmdMeasurementTypes.get(measurement, measurement), ns // 1000000000, ns % 1000000000, frametype, length))
+        last = count
+        sleep(interval)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print('Usage: %s <pmd log file>' % (sys.argv[0], ), file=sys.stderr)
+        sys.exit(1)
+    try:
+        tail(sys.argv[1])
+    except KeyboardInterrupt:
+        pass
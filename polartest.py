@@ -9,38 +9,61 @@
 # Guido Muesch <g.muesch@gmail.com>
 # 
 
+import os
 import sys
 import asyncio
 import signal
+import struct
+from array import array
+from collections import deque
+from time import monotonic_ns
 from bleak import BleakClient
 from bleak.exc import BleakError
 from bleak.uuids import uuid16_dict, uuid128_dict, uuidstr_to_str, register_uuids
 
 import platform
 from functools import partial
+from contextlib import AsyncExitStack
 from bleak import BleakScanner
 from enum import Enum, IntEnum
 
-import traceback
+import logging
+from functools import lru_cache
+from pmdlog import PMDLog, pmdMeasurementTypes
+
+# errors are reported with log.exception, the traceback is only formatted if the record is emitted,
+# POLARTEST_LOGLEVEL=CRITICAL suppresses them
+log = logging.getLogger(__name__)
 
 # some small helper functions
 def bytes2str(bytes):
-    return ' '.join(str('%02x'%b) for b in bytes)
+    return bytes.hex(' ')
 
-# uuid_to_name - map uuid to uuid name
+# uuid_to_name - map uuid to uuid name, the same few uuids are looked up repeatedly
+@lru_cache(maxsize=1024)
 def uuid_to_name(uuid):
     return None if uuid is None else uuidstr_to_str(uuid)
 
+# reverse maps for name_to_uuid, built by build_name_maps() after register_uuids()
+name2uuid128 = {}
+name2uuid16 = {}
+
+def build_name_maps():
+    name2uuid128.clear()
+    name2uuid16.clear()
+    for k, v in uuid128_dict.items():
+        name2uuid128.setdefault(v.lower(), k)
+    for k, v in uuid16_dict.items():
+        name2uuid16.setdefault(v, k)
+
 def name_to_uuid(name):
-    _name = name.lower()
-    uuids = [ k for k, v in uuid128_dict.items() if v.lower() == _name ]
-    if uuids is not None and len(uuids) > 0:
-        return uuids[0]
-    uuids = [ k for k, v in uuid16_dict.items() if v == name ]
-    if uuids is None and len(uuids) < 1:
+    uuid = name2uuid128.get(name.lower())
+    if uuid is not None:
+        return uuid
+    uuid16 = name2uuid16.get(name)
+    if uuid16 is None:
         return None
-    uuid = f"0000{uuids[0]:x}-0000-1000-8000-00805f9b34fb"
-    return uuid
+    return f"0000{uuid16:04x}-0000-1000-8000-00805f9b34fb"
 
 # List of Polar UUIDS, register with Bleak
 Polar_UUIDS = {
@@ -56,6 +79,7 @@ Polar_UUIDS = {
     }
 
 register_uuids(Polar_UUIDS)
+build_name_maps()
 
 POLAR_PFC_SERVICE = name_to_uuid("POLAR_PFC_SERVICE")
 POLAR_PFC_CP = name_to_uuid("POLAR_PFC_CP")
@@ -78,6 +102,11 @@ class PFCFlags(IntEnum):
     pfc_MC        = 1 << 7
     pfc_ANT       = 1 << 8
 
+# PFC flags reported by device_explore, as plain (mask, name) ints so the decode does no enum lookups
+PFCReported = tuple((int(f), f.name) for f in (PFCFlags.pfc_Broadcast, PFCFlags.pfc_5khz, PFCFlags.pfc_MC, PFCFlags.pfc_ANT, ))
+PFCReportedMask = sum(b for b, n in PFCReported)                # 0x183
+PFCNoneAvailable = [ (n, False) for b, n in PFCReported ]
+
 
 
 # PMD Requests
@@ -93,14 +122,7 @@ pmdMeasurementPPI = 3
 pmdMeasurementGYRO = 5
 pmdMeasurementMAG = 6
 
-pmdMeasurementTypes = {
-    0: "ECG", 
-    1: "PPG", 
-    2: "ACC", 
-    3: "PPI", 
-    5: "GYRO", 
-    6: "MAG", 
-}
+# pmdMeasurementTypes, measurement type -> name, is shared with pmdlog.py
 
 # PMD Setting Types
 pmdSetSampleRate = 0x01
@@ -110,24 +132,30 @@ pmdSetSampleRate = 0x01
 
 def polar_command(command, measurement, sample_rate=None, resolution=None, 
         range=None, range_milliunit=None, channels=None, factor=None):
-    command = bytearray([command, measurement],)
-    if sample_rate:
-        command += bytearray([0x00, 0x01, sample_rate&0xff, sample_rate>>8])
-    if resolution:
-        command += bytearray([0x01, 0x01, resolution&0xff, resolution>>8])
-    if range:
-        command += bytearray([0x02, 0x01, range&0xff, range>>8])
-    if range_milliunit:
-        command += bytearray([0x03, 0x01, range_milliunit&0xff, range_milliunit>>8])
-    if channels:
-        command += bytearray([0x04, 0x01, channels&0xff, channels>>8])
-    if factor:
-        command += bytearray([0x05, 0x01, factor&0xff, factor>>8])
-    return command
+    # each setting is [type, 0x01, value as 16 bit little endian], type is the position in this list
+    fmt = '<BB'
+    args = [command, measurement]
+    for setting, value in enumerate((sample_rate, resolution, range, range_milliunit, channels, factor)):
+        if value:
+            fmt += 'BBH'
+            args += [setting, 0x01, value]
+    return struct.pack(fmt, *args)
 
 def polar_start_stream(measurement, **kwargs):
     return polar_command(pmdStartMeasurement, measurement, **kwargs)
 
+# PMD commands used by device_explore, COMMANDS[(op, measurement)] -> bytes, op is 'get', 'start' or 'stop'
+PMD_STREAMED = (pmdMeasurementACC, pmdMeasurementECG, pmdMeasurementPPG, pmdMeasurementPPI, )
+
+COMMANDS = {
+    ('start', pmdMeasurementACC): polar_start_stream(pmdMeasurementACC, sample_rate=0x32, resolution=0x10, range=0x08),
+    ('start', pmdMeasurementECG): polar_start_stream(pmdMeasurementECG, sample_rate=130, resolution=14),
+    ('start', pmdMeasurementPPG): polar_start_stream(pmdMeasurementPPG, sample_rate=130, resolution=22),
+    ('start', pmdMeasurementPPI): polar_start_stream(pmdMeasurementPPI, ),
+}
+COMMANDS.update({ ('get', m): polar_command(pmdRequestMeasurementSettings, m) for m in PMD_STREAMED })
+COMMANDS.update({ ('stop', m): polar_command(pmdStopMeasurement, m) for m in PMD_STREAMED })
+
 # PMD Control Point Error Codes
 pmdErrorCodes = {
     0: "pmdCPSuccess",
@@ -155,7 +183,7 @@ pmdFeatureRFUsupported  = (1) << 4
 pmdFeatureGYROsupported = (1) << 5
 pmdFeatureMAGsupported  = (1) << 6
 
-FeaturesFields = [
+FeaturesFields = (
     (pmdFeatureECGsupported, 'ECG'),
     (pmdFeaturePPGsupported, 'PPG'),
     (pmdFeatureACCsupported, 'ACC'),
@@ -163,132 +191,210 @@ FeaturesFields = [
     (pmdFeatureRFUsupported, 'RFU'),
     (pmdFeatureGYROsupported,'GYRO'),
     (pmdFeatureMAGsupported, 'MAG'),
-    ]
+    )
 
-def control_notification(sender, data, name=None, msg=None ):
-    print("[%-28s %6s] %s" % (name, msg, bytes2str(data)), file=sys.stderr)
+# control point notifications are saved raw and formatted later by pmd_drain
+control_ring = deque(maxlen=4096)
 
+# the _ default arguments bind globals as locals for the notification callbacks, they are not passed by callers
+def control_notification(sender, data, name=None, msg=None, _append=control_ring.append, _bytes=bytes, ):
+    _append((name, msg, _bytes(data)))
+
+def control_drain_print():
+    while control_ring:
+        name, msg, data = control_ring.popleft()
+        print("[%-28s %6s] %s" % (name, msg, data.hex(' ')), file=sys.stderr)
+
+# statistics[device_name][measurement] -> data notification count, indexed by the PMD measurement type byte
 statistics = {}
 
-def pmd_data_notification(sender, data, device_name=None):
+def pmd_counters():
+    return array('Q', [0] * (max(pmdMeasurementTypes) + 1))
+
+# PMD data notifications are recorded in a bounded ring buffer and printed by pmd_drain,
+# the oldest entries are dropped if pmd_drain falls behind rather than blocking the callback
+pmd_ring = deque(maxlen=4096)
+
+# optional binary log, see pmdlog.py, enabled in main with POLARTEST_LOG=<file>
+pmd_log = None
+
+# PMD data notifications are queued per device by the bleak callback and processed by pmd_data_consumer,
+# the queue is bounded and the oldest notification is dropped if the consumer falls behind
+PMD_QUEUE_SIZE = 4096
+
+# bleak passes a new bytes or bytearray for each notification, so it is queued without a copy
+def pmd_data_enqueue(sender, data, queue=None, _now=monotonic_ns, ):
+    item = (_now(), data)
+    try:
+        queue.put_nowait(item)
+    except asyncio.QueueFull:
+        queue.get_nowait()
+        queue.put_nowait(item)
+
+def pmd_data_notification(ns, data, device_name=None, counts=None, log_write=None, _append=pmd_ring.append, _len=len, ):
     measurement = data[0]
-    measurement_name = pmdMeasurementTypes[measurement]
-    if device_name not in statistics:
-        statistics[device_name] = {}
-    if measurement_name not in statistics[device_name]:
-        statistics[device_name][measurement_name] = 0
-    statistics[device_name][measurement_name] += 1
+    counts[measurement] += 1
+    # the PMD timestamp is data[1:9], 8 bytes little endian, not decoded as it is not reported
     frametype = data[9]
-    raw = data[:10]
-    ms = int.from_bytes(data[1:8], byteorder='little', signed=False)
-    print("[%-30s %4s] %3d %02x len: %s" % 
-        (device_name, measurement_name, statistics[device_name][measurement_name], frametype,  len(data)), file=sys.stderr)
+    _append((device_name, ns, measurement, frametype, _len(data)))
+    if log_write is not None:
+        log_write(ns, measurement, frametype, _len(data))
 
-async def write_gatt_char(client, name, service, cp, command, msg ):
+# a bad frame is reported and skipped, it must not stop the consumer
+def pmd_data_consume(consume, ns, data):
+    try:
+        consume(ns, data)
+    except Exception:
+        log.exception('PMD data notification not processed: %s', bytes2str(data))
+
+async def pmd_data_consumer(queue, consume):
+    while True:
+        pmd_data_consume(consume, *await queue.get())
+
+# process whatever is still queued when the device is done
+def pmd_data_flush(queue, consume):
+    while not queue.empty():
+        pmd_data_consume(consume, *queue.get_nowait())
+
+# print a summary line per device and measurement for the entries in pmd_ring
+def pmd_drain_print():
+    summary = {}
+    while pmd_ring:
+        device_name, ns, measurement, frametype, length = pmd_ring.popleft()
+        n = summary.get((device_name, measurement), (0, ))[0]
+        summary[(device_name, measurement)] = (n + 1, frametype, length)
+    for (device_name, measurement), (n, frametype, length) in summary.items():
+        print("[%-30s %4s] %3d %02x len: %s +%d" % 
+            (device_name, pmdMeasurementTypes.get(measurement, measurement), statistics[device_name][measurement], frametype, length, n), file=sys.stderr)
+
+async def pmd_drain(interval=1.0):
+    while True:
+        await asyncio.sleep(interval)
+        control_drain_print()
+        pmd_drain_print()
+
+# run independent GATT operations concurrently, if one fails cancel the rest and raise its exception
+async def gather_or_cancel(*coros):
+    tasks = [ asyncio.ensure_future(c) for c in coros ]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def write_gatt_char(client, name, service, cp, command, msg, response=True, ):
     print('[%-30s %4s] %s %s' % (name, service, bytes2str(command), msg), file=sys.stderr)
     try:
-        await client.write_gatt_char(cp, command)
+        await client.write_gatt_char(cp, command, response=response)
 
     except EOFError as e:
         print('[%-30s %4s] EOFError %s ...' % (name, service, e), file=sys.stderr)
     except BleakError as e:
-        print('[%-30s %4s] BleakDBusError %s ...' % (name, service, e), file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        log.exception('[%-30s %4s] BleakDBusError %s ...', name, service, e)
         if platform.system() == 'Linux':
             print('[%-30s     ] You may need to restart Linux Bluetooth!' % (name), file=sys.stderr)
 
-async def device_explore(device, stop_event):
+async def device_explore(device, stop_event, connect_sem):
     print('[%-30s     ] Connecting' % (device.name), file=sys.stderr)
     try:
-        async with BleakClient(device) as client:
-
-            print('[%-30s     ] Client Connected' % (device.name), file=sys.stderr)
-
-            # The Linux Bleak backend provides the name differently than Windows
-            #device_name = 'unknown'
-            #if platform.system() == 'Linux':
-            #    device_name = client._properties['Name']
-            #else:
-            #    device_name = device.name
-            device_name = device.name
-
-            print('[%-30s     ] Client Connected' % (device_name), file=sys.stderr)
-
-            # Look at Services
-            services = {}
-            for service in client.services:
-                service_name = uuid_to_name(service.uuid)
-                services[service_name] = []
-                for char in service.characteristics:
-                    services[service_name].append(uuid_to_name(char.uuid)) 
-
-            for service_name, characteristics in services.items():
-                if not service_name.startswith('POLAR_'):
-                    continue
-                print('[%-30s     ] Service[%s] %s' % (device_name, service_name, characteristics), file=sys.stderr)
-
-
-            for uuid, name in Polar_UUIDS.items():
-                if not name.startswith('POLAR_'):
-                    continue
-                if name.endswith('_SERVICE'):
-                    if name not in services:
-                        print('uuid: %s NOT FOUND' % (name), file=sys.stderr)
-
-            # get PFC features
-            response = await client.read_gatt_char(POLAR_PFC_FEATURE)
-            if response is not None and len(response) > 1:
-                pfc_flags = response[1] << 8 | response[0]
-                pfc_available = [ (f.name, bool(pfc_flags&f)) 
-                    for f in PFCFlags if f in [PFCFlags.pfc_Broadcast, PFCFlags.pfc_5khz, PFCFlags.pfc_MC, PFCFlags.pfc_ANT, ]]
-                print('[%-30s     ] pfc_flags: %0x pfc_available: %s' % (device_name, pfc_flags, pfc_available), file=sys.stderr)
-            else:
-                print('[%-30s     ] PFC Feature response not valid: %s' % (device_name, response), file=sys.stderr)
-                return
-
-
-
-            # get PMD features
-            response = await client.read_gatt_char(POLAR_PMD_CP)
-            pmd_features = response[1]
-            pmd_available = [ n for b, n in FeaturesFields if pmd_features & b]
-            print('[%-30s     ] pmd_features: %s pmd_available: %s' % (device_name, pmd_features, pmd_available), file=sys.stderr)
+        async with AsyncExitStack() as stack:
+            # serialize connecting, concurrent connects contend on the BlueZ D-Bus path, the semaphore is
+            # released once the services and features are read so the next device connects while this one streams
+            async with connect_sem:
+                client = await stack.enter_async_context(BleakClient(device))
+
+                print('[%-30s     ] Client Connected' % (device.name), file=sys.stderr)
+
+                # The Linux Bleak backend provides the name differently than Windows
+                #device_name = 'unknown'
+                #if platform.system() == 'Linux':
+                #    device_name = client._properties['Name']
+                #else:
+                #    device_name = device.name
+                device_name = device.name
+
+                print('[%-30s     ] Client Connected' % (device_name), file=sys.stderr)
+
+                # Look at the Polar Services, only their characteristic names are needed
+                services = {}
+                for service in client.services:
+                    service_name = uuid_to_name(service.uuid)
+                    if not service_name.startswith('POLAR_'):
+                        continue
+                    characteristics = [ uuid_to_name(char.uuid) for char in service.characteristics ]
+                    services[service_name] = characteristics
+                    print('[%-30s     ] Service[%s] %s' % (device_name, service_name, characteristics), file=sys.stderr)
+
+
+                for uuid, name in Polar_UUIDS.items():
+                    if not name.startswith('POLAR_'):
+                        continue
+                    if name.endswith('_SERVICE'):
+                        if name not in services:
+                            print('uuid: %s NOT FOUND' % (name), file=sys.stderr)
+
+                # get PFC features
+                response = await client.read_gatt_char(POLAR_PFC_FEATURE)
+                if response is not None and len(response) > 1:
+                    pfc_flags, = struct.unpack_from('<H', response, 0)
+                    if pfc_flags & PFCReportedMask:
+                        pfc_available = [ (n, bool(pfc_flags & b)) for b, n in PFCReported ]
+                    else:
+                        pfc_available = PFCNoneAvailable
+                    print('[%-30s     ] pfc_flags: %0x pfc_available: %s' % (device_name, pfc_flags, pfc_available), file=sys.stderr)
+                else:
+                    print('[%-30s     ] PFC Feature response not valid: %s' % (device_name, response), file=sys.stderr)
+                    return
+
+
+
+                # get PMD features
+                response = await client.read_gatt_char(POLAR_PMD_CP)
+                pmd_features = response[1]
+                pmd_available = [ n for b, n in FeaturesFields if pmd_features & b]
+                print('[%-30s     ] pmd_features: %s pmd_available: %s' % (device_name, pmd_features, pmd_available), file=sys.stderr)
 
             # Start POLAR_PMD_CP and POLAR_PMD_DATA notifications
             try:
-                await client.start_notify(POLAR_PFC_CP, partial(control_notification, name=device_name, msg='PFC_CP'))
-                await client.start_notify(POLAR_PMD_CP, partial(control_notification, name=device_name, msg='PMD_CP'))
-                await client.start_notify(POLAR_PMD_DATA, partial(pmd_data_notification, device_name=device_name, ))
+                counts = statistics.setdefault(device_name, pmd_counters())
+                log_write = None
+                if pmd_log is not None:
+                    device_id = pmd_log.device_id(device_name)
+                    print('[%-30s     ] binary log device: %d' % (device_name, device_id), file=sys.stderr)
+                    log_write = partial(pmd_log.write, device_id)
+                queue = asyncio.Queue(maxsize=PMD_QUEUE_SIZE)
+                consume = partial(pmd_data_notification, device_name=device_name, counts=counts, log_write=log_write, )
+                consumer = asyncio.create_task(pmd_data_consumer(queue, consume))
+                # on exit cancel the consumer then flush the queue, before the client disconnects
+                stack.callback(pmd_data_flush, queue, consume)
+                stack.callback(consumer.cancel)
+                await gather_or_cancel(
+                    client.start_notify(POLAR_PFC_CP, partial(control_notification, name=device_name, msg='PFC_CP')),
+                    client.start_notify(POLAR_PMD_CP, partial(control_notification, name=device_name, msg='PMD_CP')),
+                    client.start_notify(POLAR_PMD_DATA, partial(pmd_data_enqueue, queue=queue)),
+                    )
             except BleakError as e:
                 print('[%-30s     ] BleakDBusError %s ...' % (device_name, e), file=sys.stderr)
                 if platform.system() == 'Linux':
                     print('[%-30s     ] You may need to restart Linux Bluetooth!' % (device_name), file=sys.stderr)
-                #print(traceback.format_exc(), file=sys.stderr)
+                #log.exception('[%-30s     ] BleakDBusError', device_name)
                 return
 
 
-            if 'ACC' in pmd_available:
-                await write_gatt_char(client, device_name, 'ACC', POLAR_PMD_CP, 
-                    polar_command(pmdRequestMeasurementSettings, pmdMeasurementACC), "Get ACC Settings")
-                await write_gatt_char(client, device_name, 'ACC', POLAR_PMD_CP, 
-                    polar_start_stream (pmdMeasurementACC, sample_rate=0x32, resolution=0x10, range=0x08), "Start ACC measurement")
+            # use write-without-response on the PMD control point if the device supports it,
+            # allows more than one write in flight instead of waiting for each write response
+            pmd_cp = client.services.get_characteristic(POLAR_PMD_CP)
+            pmd_cp_response = pmd_cp is None or 'write-without-response' not in pmd_cp.properties
 
-            if 'ECG' in pmd_available:
-                await write_gatt_char(client, device_name, 'ECG', POLAR_PMD_CP, 
-                    polar_command(pmdRequestMeasurementSettings, pmdMeasurementECG), "Get ECG Settings")
-                await write_gatt_char(client, device_name, 'ECG', POLAR_PMD_CP, 
-                    polar_start_stream(pmdMeasurementECG, sample_rate=130, resolution=14), "Start ECG measurement")
-
-            if 'PPG' in pmd_available:
-                await write_gatt_char(client, device_name, 'PPG', POLAR_PMD_CP, 
-                    polar_command(pmdRequestMeasurementSettings, pmdMeasurementPPG), "Get PPG Settings")
-                await write_gatt_char(client, device_name, 'PPG', POLAR_PMD_CP, 
-                    polar_start_stream(pmdMeasurementPPG, sample_rate=130, resolution=22), "Start PPG measurement")
-
-            if 'PPI' in pmd_available:
-                await write_gatt_char(client, device_name, 'PPI', POLAR_PMD_CP, polar_command(pmdRequestMeasurementSettings, pmdMeasurementPPI), "Get PPI Settings")
-                await write_gatt_char(client, device_name, 'PPI', POLAR_PMD_CP, 
-                    polar_start_stream(pmdMeasurementPPI, ), "Start PPI measurement")
+            for measurement in PMD_STREAMED:
+                service = pmdMeasurementTypes[measurement]
+                if service in pmd_available:
+                    await write_gatt_char(client, device_name, service, POLAR_PMD_CP, 
+                        COMMANDS[('get', measurement)], "Get %s Settings" % (service), response=pmd_cp_response)
+                    await write_gatt_char(client, device_name, service, POLAR_PMD_CP, 
+                        COMMANDS[('start', measurement)], "Start %s measurement" % (service), response=pmd_cp_response)
 
             # Sleep a few seconds while streaming data comes in
             #await asyncio.sleep(60)
@@ -296,39 +402,45 @@ async def device_explore(device, stop_event):
             print('[%-30s     ] device_explore stopping' % (device.name))
 
 
-            # Stop measurement
+            # Stop measurement, the stops are independent so send them together when the control point is
+            # write-without-response, write requests are one at a time (BlueZ returns InProgress otherwise)
             # N.b. To stop only one measurement, you need to stop all and restart the ones still needed.
-            if 'ACC' in pmd_available:
-                await write_gatt_char(client, device_name, 'ACC', POLAR_PMD_CP, polar_command(pmdStopMeasurement, pmdMeasurementACC), 'Stop ACC Measurement', )
-            if 'ECG' in pmd_available:
-                await write_gatt_char(client, device_name, 'ECG', POLAR_PMD_CP, polar_command(pmdStopMeasurement, pmdMeasurementECG), 'Stop ECG Measurement', )
-            if 'PPG' in pmd_available:
-                await write_gatt_char(client, device_name, 'PPG', POLAR_PMD_CP, polar_command(pmdStopMeasurement, pmdMeasurementPPG), 'Stop PPG Measurement', )
-            if 'PPI' in pmd_available:
-                await write_gatt_char(client, device_name, 'PPI', POLAR_PMD_CP, polar_command(pmdStopMeasurement, pmdMeasurementPPI), 'Stop PPI Measurement', )
+            stops = [ write_gatt_char(client, device_name, pmdMeasurementTypes[m], POLAR_PMD_CP, COMMANDS[('stop', m)],
+                        'Stop %s Measurement' % (pmdMeasurementTypes[m]), response=pmd_cp_response, )
+                    for m in PMD_STREAMED if pmdMeasurementTypes[m] in pmd_available ]
+            if pmd_cp_response:
+                for stop in stops:
+                    await stop
+            else:
+                await asyncio.gather(*stops)
 
             # Stop notifications
             try:
-                await client.stop_notify(POLAR_PMD_DATA)
-                await client.stop_notify(POLAR_PMD_CP)
-                await client.stop_notify(POLAR_PFC_CP)
+                await gather_or_cancel(
+                    client.stop_notify(POLAR_PMD_DATA),
+                    client.stop_notify(POLAR_PMD_CP),
+                    client.stop_notify(POLAR_PFC_CP),
+                    )
             except BleakError as e:
-                print('BleakDBusError %s ...' % (e), file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
+                log.exception('BleakDBusError %s ...', e)
                 if platform.system() == 'Linux':
                     print('[%-30s     ] You may need to restart Linux Bluetooth!' % (''), file=sys.stderr)
     except asyncio.exceptions.TimeoutError as e:
-        print('BleakClient timeout: %s' % (e), file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        log.exception('BleakClient timeout: %s', e)
     
     print('[%-30s     ] device_explore exiting' % (device.name))
 
 
 async def main(wanted_name):
+    global pmd_log
 
     print('[%-35s] looking for %s' % ('Main', wanted_name), file=sys.stderr)
+    if os.environ.get('POLARTEST_LOG'):
+        pmd_log = PMDLog(os.environ['POLARTEST_LOG'])
+        print('[%-35s] binary log %s' % ('Main', os.environ['POLARTEST_LOG']), file=sys.stderr)
     tasks = {}
     stop_event = asyncio.Event()
+    connect_sem = asyncio.Semaphore(1)
     def sigint_handler():
         print()
         #print('sigint_handler: ', file=sys.stderr)
@@ -336,16 +448,30 @@ async def main(wanted_name):
         #    task.stop()
         stop_event.set()
 
-    signal.signal(signal.SIGINT, lambda signal, frame: sigint_handler())
+    # add_signal_handler wakes the event loop immediately, not available on Windows
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, sigint_handler)
+    except NotImplementedError:
+        signal.signal(signal.SIGINT, lambda signal, frame: sigint_handler())
 
+    drain_task = asyncio.create_task(pmd_drain())
+
+
+    # the callback sees every advertisement, each (address, name) is only checked once, a device is checked
+    # again if its name changes, e.g. from an address style alias or short name to the full local name
+    wanted_lower = wanted_name.lower()
+    seen = set()
 
     def callback(dev, ad):
         #print('[%-35s] callback dev: %s' % ('BleakScanner', dir(dev), ), file=sys.stderr)
         #print('[%-35s] callback tasks: %s' % ('BleakScanner', tasks), file=sys.stderr)
 
-        if dev.name is not None and wanted_name.lower() in dev.name.lower() and dev.name not in tasks:
+        if not dev.name or (dev.address, dev.name) in seen:
+            return
+        seen.add((dev.address, dev.name))
+        if wanted_lower in dev.name.lower() and dev.name not in tasks:
             print('[%-35s] founnd %s' % ('BleakScanner', dev.name, ), file=sys.stderr)
-            tasks[dev.name] = asyncio.create_task(device_explore(dev, stop_event))
+            tasks[dev.name] = asyncio.create_task(device_explore(dev, stop_event, connect_sem))
 
     try:
         async with BleakScanner(detection_callback=callback, scanning_mode="active") as scanner:
@@ -356,29 +482,33 @@ async def main(wanted_name):
             await asyncio.gather(*[ task for name, task in tasks.items()])
             print('[%-35s] exiting, tasks gathered' % ('BleakScanner'), file=sys.stderr)
 
-        for device_name, stats in statistics.items():
+        drain_task.cancel()
+        control_drain_print()
+        pmd_drain_print()
+
+        for device_name, counts in statistics.items():
             print('')
-            for measurement_name, count in stats.items():
-                print('[%-30s %4s] data notifications: %3d  ' % (device_name, measurement_name, count, ))
+            for measurement, count in enumerate(counts):
+                if count:
+                    print('[%-30s %4s] data notifications: %3d  ' % (device_name, pmdMeasurementTypes.get(measurement, measurement), count, ))
         print('')
 
 
 
     except BleakError as e:
-        print('BleakDBusError %s ...' % (e), file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        log.exception('BleakDBusError %s ...', e)
         if platform.system() == 'Linux':
             print('[%-30s     ] You may need to restart Linux Bluetooth!' % (''), file=sys.stderr)
         await asyncio.sleep(2)
     except OSError as e:
-        print('OSError %s ...' % (e), file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        log.exception('OSError %s ...', e)
         await asyncio.sleep(2)
     except Exception as e:
-        print('BLE_Scanner.task: e: %s' % (e, ), file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        log.exception('BLE_Scanner.task: e: %s', e)
         await asyncio.sleep(2)
 
+    if pmd_log is not None:
+        pmd_log.close()
     exit()
 
 
@@ -386,6 +516,7 @@ async def main(wanted_name):
 
 
 if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, format='%(message)s', level=os.environ.get('POLARTEST_LOGLEVEL', 'WARNING'))
     name = 'Polar' if len(sys.argv) == 1 else sys.argv[1]
     asyncio.run(main(name))  # H10
     print("DONE", file=sys.stderr)